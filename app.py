@@ -1,12 +1,22 @@
 import sqlite3
-import pandas as pd
 import json
 import os
+import hashlib
+from collections import OrderedDict
+import heapq
 import re
+import sys
+import pickle
 import logging
+import threading
 from flask import Flask, request, jsonify
 from flask_cors import CORS
 
+try:
+    import ahocorasick
+except ImportError:
+    ahocorasick = None
+
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
@@ -15,42 +25,232 @@ DB_NAME = os.path.join(basedir, 'recipe_recommender.db')
 RECIPES_JSON = os.path.join(basedir, 'recipes.json')
 MAPPINGS_JSON = os.path.join(basedir, 'mappings.json')
 UPLOAD_FOLDER = os.path.join(basedir, 'uploads')
+CACHE_FILE = os.path.join(basedir, 'data_cache.pkl')
+CACHE_VERSION = 6
+MAX_IMAGE_BYTES = 10 * 1024 * 1024  # 업로드 이미지 상한 10MB
+OCR_CACHE_SIZE = 128  # 내용 해시 기준 OCR 결과 캐시 항목 수
 
-recipes_df = None
 material_map = None
 material_regex = None
+material_prefilter = None
+material_automaton = None
+vision_client = None
+
+# 지연 초기화 보호용 락 (멀티스레드 워커에서 중복 초기화 방지)
+_load_lock = threading.RLock()  # initialize_database가 재진입하므로 RLock
+_vision_lock = threading.Lock()
+
+# 같은 이미지 재업로드 시 Vision API 재호출 방지 (내용 해시 -> OCR 줄 목록)
+_ocr_cache = OrderedDict()
+_ocr_cache_lock = threading.Lock()
+
+# 레시피 컬럼별 리스트 (로드 시 1회 파싱, 요청마다 재파싱 없음)
+_recipe_names = []
+_recipe_images = []
+_recipe_steps = []
+_recipe_all_sets = []
+_recipe_all_len = []
+
+# 재료명 -> 비트 번호, 레시피별 정수 비트마스크 (점수 계산은 정수 연산만)
+_material_ids = {}
+_recipe_core_masks = []
+_recipe_all_masks = []
+
+# 역색인: 재료 -> 해당 재료를 쓰는 레시피 인덱스 목록
+_material_to_recipes = {}
 
 # ------------------------------------------
 # 데이터 로드 관련 함수
 # ------------------------------------------
-def load_data_to_memory():
-    global recipes_df, material_map, material_regex
-
-    if recipes_df is not None and material_map is not None:
-        return
-
-    if not os.path.exists(DB_NAME):
-        initialize_database()
+def _parse_required_materials(raw):
+    """DB의 required_materials JSON을 (core, optional) set 쌍으로 변환"""
+    required = json.loads(raw)
+    if isinstance(required, dict):
+        core = required.get('core', [])
+        opt = required.get('optional', [])
+    else:
+        core, opt = [], required
+    # 같은 재료명이 레시피마다 반복되므로 intern으로 문자열 공유
+    return {sys.intern(m) for m in core}, {sys.intern(m) for m in opt}
+
+def _build_recipe_tables(rows):
+    global _recipe_names, _recipe_images, _recipe_steps
+    global _recipe_all_sets, _recipe_all_len, _material_to_recipes
+    global _material_ids, _recipe_core_masks, _recipe_all_masks
+
+    names, images, steps = [], [], []
+    all_sets, all_lens = [], []
+    mat_index = {}
+    material_ids = {}
+    core_masks, all_masks = [], []
+
+    # 동일 재료 조합은 frozenset 하나를 공유
+    set_pool = {}
+
+    def share(materials):
+        fs = frozenset(materials)
+        return set_pool.setdefault(fs, fs)
+
+    def to_mask(materials):
+        mask = 0
+        for material in materials:
+            bit = material_ids.setdefault(material, len(material_ids))
+            mask |= 1 << bit
+        return mask
+
+    for name, raw, step, image in rows:
+        core, opt = _parse_required_materials(raw)
+        all_required = core | opt
+        idx = len(names)
+        names.append(name)
+        images.append(image)
+        steps.append(step)
+        all_sets.append(share(all_required))
+        all_lens.append(len(all_required))
+        core_masks.append(to_mask(core))
+        all_masks.append(to_mask(all_required))
+        for material in all_required:
+            mat_index.setdefault(material, []).append(idx)
+
+    # 로드 후에는 전부 읽기 전용 → 불변 튜플로 고정 (preload 후 워커 간 공유)
+    _recipe_names, _recipe_images, _recipe_steps = tuple(names), tuple(images), tuple(steps)
+    _recipe_all_sets = tuple(all_sets)
+    _recipe_all_len = tuple(all_lens)
+    _material_to_recipes = {m: tuple(idxs) for m, idxs in mat_index.items()}
+    _material_ids = material_ids
+    _recipe_core_masks, _recipe_all_masks = tuple(core_masks), tuple(all_masks)
+
+def _build_material_matcher(mapping):
+    """키워드 -> 재료 매핑으로 매칭기 구성 (Aho-Corasick, 불가 시 정규식)"""
+    global material_regex, material_prefilter, material_automaton
+
+    if ahocorasick is not None:
+        automaton = ahocorasick.Automaton()
+        for keyword, material in mapping.items():
+            automaton.add_word(keyword, material)
+        automaton.make_automaton()
+        material_automaton = automaton
         return
 
+    sorted_keys = sorted(mapping.keys(), key=len, reverse=True)
+    material_regex = re.compile('|'.join(map(re.escape, sorted_keys)))
+    # 선두 글자 문자 클래스 프리필터: 교대 패턴보다 훨씬 싼 스캔으로 줄을 거름
+    first_chars = {k[0] for k in mapping if k}
+    material_prefilter = re.compile('[' + re.escape(''.join(first_chars)) + ']')
+
+def _save_cache():
+    """파싱 완료된 구조를 pickle 스냅샷으로 저장 (다음 부팅 시 재파싱 생략)"""
+    state = {
+        'version': CACHE_VERSION,
+        'db_mtime': os.path.getmtime(DB_NAME),
+        'material_map': material_map,
+        'recipe_names': _recipe_names,
+        'recipe_images': _recipe_images,
+        'recipe_steps': _recipe_steps,
+        'recipe_all_sets': _recipe_all_sets,
+        'recipe_all_len': _recipe_all_len,
+        'material_ids': _material_ids,
+        'recipe_core_masks': _recipe_core_masks,
+        'recipe_all_masks': _recipe_all_masks,
+        'material_to_recipes': _material_to_recipes,
+    }
     try:
-        conn = sqlite3.connect(DB_NAME, check_same_thread=False)
-        recipes_df = pd.read_sql_query("SELECT * FROM Recipes", conn)
-
-        cursor = conn.cursor()
-        cursor.execute("SELECT receipt_item, standard_material FROM MaterialMapping")
-        rows = cursor.fetchall()
-        conn.close()
+        with open(CACHE_FILE, 'wb') as f:
+            pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+    except OSError as e:
+        logger.warning(f"캐시 저장 실패: {e}")
+
+def _load_cache():
+    """스냅샷이 DB보다 최신이면 복원하고 material_map을 반환 (실패 시 None)
+
+    material_map 전역은 건드리지 않음 - 락 없이 읽는 스레드가 맵을 보기
+    전에 매칭기가 준비되도록, 맵 공개는 호출 측에서 마지막에 수행한다.
+    """
+    global _recipe_names, _recipe_images, _recipe_steps
+    global _recipe_all_sets, _recipe_all_len, _material_to_recipes
+    global _material_ids, _recipe_core_masks, _recipe_all_masks
+
+    if not os.path.exists(CACHE_FILE):
+        return None
+
+    # 깨졌거나 호환되지 않는 스냅샷은 어떤 예외든 일반 빌드로 폴백해야 하므로
+    # 로드/검증/추출 전체를 넓게 감싼다 (전역 반영은 성공 후에만)
+    try:
+        with open(CACHE_FILE, 'rb') as f:
+            state = pickle.load(f)
+
+        if state.get('version') != CACHE_VERSION:
+            return None
+        if state.get('db_mtime') != os.path.getmtime(DB_NAME):
+            return None
+
+        names = state['recipe_names']
+        images = state['recipe_images']
+        steps = state['recipe_steps']
+        all_sets = state['recipe_all_sets']
+        all_len = state['recipe_all_len']
+        material_ids = state['material_ids']
+        core_masks = state['recipe_core_masks']
+        all_masks = state['recipe_all_masks']
+        mat_index = state['material_to_recipes']
+        mapping = state['material_map']
+    except Exception as e:
+        logger.warning(f"캐시 로드 실패: {e}")
+        return None
 
-        material_map = {item: material for item, material in rows}
+    _recipe_names, _recipe_images, _recipe_steps = names, images, steps
+    _recipe_all_sets = all_sets
+    _recipe_all_len = all_len
+    _material_ids = material_ids
+    _recipe_core_masks, _recipe_all_masks = core_masks, all_masks
+    _material_to_recipes = mat_index
+    return mapping
 
-        sorted_keys = sorted(material_map.keys(), key=len, reverse=True)
-        material_regex = re.compile('|'.join(map(re.escape, sorted_keys)))
+def load_data_to_memory():
+    global material_map
 
-        logger.info("데이터 로드 완료")
+    if _recipe_names and material_map is not None:
+        return
 
-    except Exception as e:
-        logger.error(f"데이터 로드 오류: {e}")
+    # 더블 체크 락: 동시에 들어온 요청 중 한 스레드만 실제 로드 수행
+    with _load_lock:
+        if _recipe_names and material_map is not None:
+            return
+
+        if not os.path.exists(DB_NAME):
+            initialize_database()
+            return
+
+        try:
+            cached_map = _load_cache()
+            if cached_map is not None:
+                # 매칭기는 스냅샷에 넣지 않고 항상 재구축 (수백 키워드라 저렴하고,
+                # C 확장이 없는 호스트에서도 정규식 폴백으로 자연히 내려감)
+                _build_material_matcher(cached_map)
+                # 맵 공개는 항상 매칭기 준비 후 (락 없는 fast path가 맵만 검사)
+                material_map = cached_map
+                logger.info("캐시에서 데이터 로드 완료")
+                return
+
+            conn = sqlite3.connect(DB_NAME)
+            cursor = conn.cursor()
+            cursor.execute("SELECT name, required_materials, steps, image_url FROM Recipes")
+            _build_recipe_tables(cursor.fetchall())
+
+            cursor.execute("SELECT keyword, standard_material FROM MaterialMapping")
+            rows = cursor.fetchall()
+            conn.close()
+
+            # 표준 재료명은 중복이 많으므로 intern으로 동일 문자열 객체 공유
+            mapping = {keyword: sys.intern(material) for keyword, material in rows}
+            _build_material_matcher(mapping)
+            material_map = mapping
+            _save_cache()
+
+            logger.info("데이터 로드 완료")
+
+        except Exception as e:
+            logger.error(f"데이터 로드 오류: {e}")
 
 def initialize_database():
     logger.info("DB 초기화 시작")
@@ -66,10 +266,13 @@ def initialize_database():
 
         if not os.path.exists(MAPPINGS_JSON):
             with open(MAPPINGS_JSON, 'w', encoding='utf-8') as f:
-                json.dump([{"item": "김치", "material": "김치"}], f, ensure_ascii=False, indent=2)
+                json.dump([{"keyword": "김치", "material": "김치"}], f, ensure_ascii=False, indent=2)
 
     conn = sqlite3.connect(DB_NAME)
     cur = conn.cursor()
+    # 초기화는 통째로 다시 만드는 작업이라 내구성 보장 불필요 → fsync 생략
+    cur.execute("PRAGMA synchronous = OFF")
+    cur.execute("PRAGMA journal_mode = MEMORY")
     cur.execute("DROP TABLE IF EXISTS Recipes")
     cur.execute("DROP TABLE IF EXISTS MaterialMapping")
 
@@ -86,89 +289,165 @@ def initialize_database():
     cur.execute("""
         CREATE TABLE MaterialMapping (
             mapping_id INTEGER PRIMARY KEY,
-            receipt_item TEXT NOT NULL UNIQUE,
+            keyword TEXT NOT NULL UNIQUE,
             standard_material TEXT NOT NULL
         )
     """)
 
     with open(RECIPES_JSON, 'r', encoding='utf-8') as f:
         recipes = json.load(f)
-        for r in recipes:
-            cur.execute("INSERT INTO Recipes (name, required_materials, steps, image_url) VALUES (?, ?, ?, ?)",
-                        (r["name"], json.dumps(r["materials"], ensure_ascii=False), r.get("steps", ""), r.get("image_url", "")))
+    cur.executemany(
+        "INSERT INTO Recipes (name, required_materials, steps, image_url) VALUES (?, ?, ?, ?)",
+        [(r["name"], json.dumps(r["materials"], ensure_ascii=False, separators=(',', ':')),
+          r.get("steps", ""), r.get("image_url", "")) for r in recipes])
 
     with open(MAPPINGS_JSON, 'r', encoding='utf-8') as f:
         mappings = json.load(f)
-        for m in mappings:
-            try:
-                cur.execute("INSERT INTO MaterialMapping (receipt_item, standard_material) VALUES (?, ?)",
-                            (m["item"], m["material"]))
-            except:
-                pass
+    # OR IGNORE: 중복 키워드는 기존처럼 건너뜀
+    cur.executemany(
+        "INSERT OR IGNORE INTO MaterialMapping (keyword, standard_material) VALUES (?, ?)",
+        [(m["keyword"], m["material"]) for m in mappings])
 
     conn.commit()
     conn.close()
+
+    # 재구축이 끝나면 WAL로 전환: 이후 읽기가 쓰기와 블로킹 없이 공존
+    # (MEMORY 저널 연결에서는 전환이 잠금을 남기므로 새 연결에서 수행)
+    wal_conn = sqlite3.connect(DB_NAME)
+    wal_conn.execute("PRAGMA journal_mode = WAL")
+    wal_conn.close()
+
     logger.info("DB 초기화 완료")
     load_data_to_memory()
 
 # ------------------------------------------
 # 매칭 / 추천 함수
 # ------------------------------------------
-def calculate_match_score(required, available):
-    core = set(required.get('core', []))
-    opt = set(required.get('optional', []))
-    available = set(available)
-
-    missing_core = core - available
-    if missing_core:
-        return 0, set(), core.union(opt) - available
-
-    all_required = core.union(opt)
-    matched = all_required.intersection(available)
-    missing = all_required - available
-    ratio = len(matched) / len(all_required) if len(all_required) > 0 else 0
-
-    return ratio, matched, missing
-
 def recommend_recipes(standard_materials, top_n=5):
-    global recipes_df
-    if recipes_df is None:
+    if not _recipe_names:
         load_data_to_memory()
 
+    available = set(standard_materials)
+    avail_mask = 0
+    for material in available:
+        bit = _material_ids.get(material)
+        if bit is not None:
+            avail_mask |= 1 << bit
+
+    # 역색인으로 재료가 하나라도 겹치는 레시피만 후보로 추림
+    candidates = set()
+    for material in available:
+        candidates.update(_material_to_recipes.get(material, ()))
+
+    # 내부 루프는 정수 비트 연산만 수행, 재료 목록은 상위 결과에만 구성
+    scored = []
+    for i in candidates:
+        core_mask = _recipe_core_masks[i]
+        if core_mask & avail_mask != core_mask:
+            continue
+        matched_count = (_recipe_all_masks[i] & avail_mask).bit_count()
+        if matched_count == 0:
+            continue
+        scored.append((matched_count / _recipe_all_len[i], i))
+
+    # 전체 정렬 대신 상위 top_n만 힙으로 선별 (후보 수 >> top_n)
+    top = heapq.nlargest(top_n, scored, key=lambda t: t[0])
+
     recommendations = []
-    for _, row in recipes_df.iterrows():
-        required = json.loads(row['required_materials'])
-        ratio, matched, missing = calculate_match_score(required, standard_materials)
-        if ratio > 0:
-            recommendations.append({
-                "name": row["name"],
-                "match_ratio": int(ratio * 100),
-                "matched": list(matched),
-                "missing": list(missing)
-            })
-
-    recommendations.sort(key=lambda x: x["match_ratio"], reverse=True)
-    return recommendations[:top_n]
+    for ratio, i in top:
+        recommendations.append({
+            "name": _recipe_names[i],
+            "match_ratio": int(ratio * 100),
+            "matched": list(_recipe_all_sets[i] & available),
+            "missing": list(_recipe_all_sets[i] - available)
+        })
+    return recommendations
 
 def process_material_lines(lines):
-    global material_map, material_regex
+    global material_map
     if material_map is None:
         load_data_to_memory()
 
     std = set()
-    for line in lines:
-        matches = material_regex.findall(line)
-        for m in matches:
+    if material_automaton is not None:
+        # 줄 단위 루프 대신 영수증 전체를 한 번에 스캔 (키워드에 개행 없음)
+        # iter_long: 최장 일치만 보고해 기존 정규식(긴 키워드 우선)과 동일 의미
+        text = "\n".join(lines)
+        for _, material in material_automaton.iter_long(text):
+            std.add(material)
+    else:
+        # 프리필터 통과 줄만 이어붙여 교대 패턴 스캔을 요청당 1회로 줄임
+        text = "\n".join(line for line in lines if material_prefilter.search(line))
+        for m in material_regex.findall(text):
             std.add(material_map.get(m))
 
     return list(std)
 
+# ------------------------------------------
+# OCR (Google Vision) 관련 함수
+# ------------------------------------------
+def get_vision_client():
+    global vision_client
+    if vision_client is None:
+        with _vision_lock:
+            if vision_client is None:
+                from google.cloud import vision
+                vision_client = vision.ImageAnnotatorClient()
+    return vision_client
+
+def _read_upload_bytes(file, limit=MAX_IMAGE_BYTES):
+    """업로드 스트림을 청크 단위로 읽음. 상한 초과 시 None 반환"""
+    chunks = []
+    total = 0
+    while True:
+        chunk = file.stream.read(64 * 1024)
+        if not chunk:
+            break
+        total += len(chunk)
+        if total > limit:
+            return None
+        chunks.append(chunk)
+    return b''.join(chunks)
+
+def extract_text_lines(content):
+    """이미지 바이트에서 OCR로 텍스트 줄 목록 추출 (동일 이미지 결과는 캐시)"""
+    key = hashlib.sha256(content).digest()
+    with _ocr_cache_lock:
+        if key in _ocr_cache:
+            _ocr_cache.move_to_end(key)
+            return _ocr_cache[key]
+
+    from google.cloud import vision
+
+    client = get_vision_client()
+    image = vision.Image(content=content)
+    response = client.text_detection(image=image)
+
+    if response.error.message:
+        raise RuntimeError(response.error.message)
+
+    if not response.text_annotations:
+        lines = []
+    else:
+        lines = response.text_annotations[0].description.splitlines()
+
+    with _ocr_cache_lock:
+        _ocr_cache[key] = lines
+        _ocr_cache.move_to_end(key)
+        while len(_ocr_cache) > OCR_CACHE_SIZE:
+            _ocr_cache.popitem(last=False)
+
+    return lines
+
 # ------------------------------------------
 # Flask API
 # ------------------------------------------
 app = Flask(__name__)
 CORS(app)
 
+# gunicorn --preload: 마스터 프로세스에서 미리 로드해 워커들이 CoW로 공유
+load_data_to_memory()
+
 @app.route("/", methods=["GET"])
 def home():
     return jsonify({"status": "ok"}), 200
@@ -189,6 +468,34 @@ def recommend_api():
         "recommendations": result
     })
 
+@app.route("/recommend/image", methods=["POST"])
+def recommend_from_image():
+    load_data_to_memory()
+
+    file = request.files.get("receipt_image")
+    if file is None:
+        return jsonify({"status": "error", "message": "receipt_image 파일이 없습니다"}), 400
+
+    # 통째로 read() 하지 않고 청크 단위로 읽어 메모리 사용을 상한 이내로 제한
+    content = _read_upload_bytes(file)
+    if content is None:
+        return jsonify({"status": "error", "message": "이미지가 너무 큽니다 (10MB 제한)"}), 413
+
+    try:
+        lines = extract_text_lines(content)
+    except Exception as e:
+        logger.error(f"OCR 오류: {e}")
+        return jsonify({"status": "error", "message": "OCR 처리 실패"}), 502
+
+    std = process_material_lines(lines)
+    result = recommend_recipes(std, top_n=5)
+
+    return jsonify({
+        "status": "success",
+        "standard_materials": std,
+        "recommendations": result
+    })
+
 # ------------------------------------------
 # local server
 # ------------------------------------------